@@ -1,15 +1,55 @@
+import functools
 import hashlib
+import json
 import numpy as np
 import os
 import re
 import requests
+import shutil
+import subprocess
 import tarfile
+import threading
 import time
+import warnings
 import random
 
+from concurrent import futures
+
 from absl import logging
-from typing import List, NoReturn, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from typing import List, NoReturn, Optional, Sequence, Tuple
+
+# (connect, read) timeout in seconds for all HTTP requests
+HTTP_TIMEOUT = (5, 30)
+# Upper limit in seconds for the wait between two polls of the MMSeqs2 server
+MAX_POLL_INTERVAL = 30
+# Buffer size in bytes for reading and writing large files
+IO_BUFFER_SIZE = 2 * 1024 * 1024
+# Number of concurrent GPCRdb lookups
+MAX_WORKERS = 16
+# Number of pdb codes or structure IDs per KLIFS request
+KLIFS_BATCH_SIZE = 100
+# Activation states and signalling proteins annotated in the GPCRdb
+GPCRDB_STATES = ["Active", "Inactive", "Intermediate", "G protein", "Arrestin"]
+# Letters that are dropped from input sequences
+NONCANONICAL_AAS = frozenset("BJOUXZ")
+
+# Runs of characters that are not allowed in job names
+_NONWORD = re.compile(r"\W+")
+
+
+class _CanonicalTable(dict):
+    """Translation table for str.translate that deletes every unmapped character."""
+
+    def __missing__(self, key):
+        return None
+
 
+# Keeps the 20 canonical amino acids and deletes everything else in a single pass
+_CANONICAL_AAS_TABLE = _CanonicalTable(
+    (ord(aa), ord(aa)) for aa in "ABCDEFGHIJKLMNOPQRSTUVWXYZ" if aa not in NONCANONICAL_AAS
+)
 
 def get_subfamily(protein : str) -> str:
     """Fetch a protein's subfamily from the GPCRdb."""
@@ -54,6 +94,8 @@ class MMSeqs2Runner:
     self.n_templates = Number of templates to fetch (default=20)
     self.path: Path to use
     self.tarfile: Compressed file archive to download
+    self.session: HTTP session shared by all requests (keep-alive, retries)
+    self._cache_dir: Directory holding cached GPCRdb/KLIFS responses
     """
 
     def __init__(
@@ -93,11 +135,24 @@ class MMSeqs2Runner:
 
         self.path = "_".join((self.job, path_suffix))
 
-        if not os.path.isdir(self.path):
-            os.system(f"mkdir { self.path }")
-
         self.tarfile = f"{ self.path }/out.tar.gz"
 
+        # Also creates self.path
+        self._cache_dir = os.path.join(self.path, ".http_cache")
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+        # Reuse connections across the many MMseqs2/GPCRdb/KLIFS requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=5, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
     def _cleanseq(self, seq) -> str:
 
         r"""Cleans the sequence to remove whitespace and noncanonical letters
@@ -112,12 +167,11 @@ class MMSeqs2Runner:
 
         """
 
-        if any([aa in seq for aa in "BJOUXZ"]):
+        if not NONCANONICAL_AAS.isdisjoint(seq):
             logging.warning("Sequence contains non-canonical amino acids!")
             logging.warning("Removing B, J, O, U, X, and Z from sequence")
-            seq = re.sub(r"[BJOUXZ]", "", seq)
 
-        return re.sub(r"[^A-Z]", "", "".join(seq.split()))
+        return seq.translate(_CANONICAL_AAS_TABLE)
 
     def _define_jobname(self, job: str) -> str:
 
@@ -135,12 +189,12 @@ class MMSeqs2Runner:
 
         return "_".join(
             (
-                re.sub(r"\W+", "", "".join(job.split())),
+                _NONWORD.sub("", "".join(job.split())),
                 hashlib.sha1(self.seq.encode()).hexdigest()[:5],
             )
         )
 
-    def _submit(self) -> dict:
+    def _submit(self) -> Tuple[dict, str]:
 
         r"""Submit job to MMSeqs2 server
 
@@ -150,13 +204,15 @@ class MMSeqs2Runner:
 
         Returns
         ----------
-        None
+        Tuple with [0] response from server, and [1] Retry-After header (None if absent)
 
         """
 
         data = {"q": f">101\n{ self.seq }", "mode": "env"}
 
-        res = requests.post(f"{ self.host_url }/ticket/msa", data=data)
+        res = self.session.post(
+            f"{ self.host_url }/ticket/msa", data=data, timeout=HTTP_TIMEOUT
+        )
 
         try:
             out = res.json()
@@ -164,9 +220,9 @@ class MMSeqs2Runner:
         except ValueError:
             out = {"status": "UNKNOWN"}
 
-        return out
+        return out, res.headers.get("Retry-After")
 
-    def _status(self, idx: str) -> dict:
+    def _status(self, idx: str) -> Tuple[dict, str]:
 
         r"""Check status of job
 
@@ -176,11 +232,11 @@ class MMSeqs2Runner:
 
         Returns
         ----------
-        None
+        Tuple with [0] response from server, and [1] Retry-After header (None if absent)
 
         """
 
-        res = requests.get(f"{ self.host_url }/ticket/{ idx }")
+        res = self.session.get(f"{ self.host_url }/ticket/{ idx }", timeout=HTTP_TIMEOUT)
 
         try:
             out = res.json()
@@ -188,7 +244,7 @@ class MMSeqs2Runner:
         except ValueError:
             out = {"status": "UNKNOWN"}
 
-        return out
+        return out, res.headers.get("Retry-After")
 
     def _download(self, idx: str, path: str) -> NoReturn:
 
@@ -205,10 +261,41 @@ class MMSeqs2Runner:
 
         """
 
-        res = requests.get(f"{ self.host_url }/result/download/{ idx }")
+        # Stream to disk instead of holding the whole archive in memory; write to a
+        # temporary file first, so an interrupted download is not mistaken for a result
+        with self.session.get(
+            f"{ self.host_url }/result/download/{ idx }", stream=True, timeout=HTTP_TIMEOUT
+        ) as res:
+            res.raise_for_status()
+            with open(f"{ path }.part", "wb") as out:
+                for chunk in res.iter_content(chunk_size=IO_BUFFER_SIZE):
+                    out.write(chunk)
+
+        os.replace(f"{ path }.part", path)
+
+    def _wait(self, attempt: int, retry_after: str = None) -> NoReturn:
+
+        r"""Sleep before contacting the MMSeqs2 server again
+
+        Parameters
+        ----------
+        attempt : Number of consecutive polls without progress
+        retry_after : Retry-After header sent by the server, if any
+
+        Returns
+        ----------
+        None
+
+        """
+
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            # No (numeric) hint from the server: back off exponentially
+            delay = min(1.5 ** attempt, MAX_POLL_INTERVAL)
 
-        with open(path, "wb") as out:
-            out.write(res.content)
+        # Jitter to avoid all clients polling at the same time
+        time.sleep(delay + random.uniform(0, 0.5))
 
     def _search_mmseqs2(self) -> NoReturn:
 
@@ -228,22 +315,28 @@ class MMSeqs2Runner:
         if os.path.isfile(self.tarfile):
             return
 
-        out = self._submit()
+        out, retry_after = self._submit()
 
-        time.sleep(5 + np.random.randint(0, 5))
+        attempt = 0
         while out["status"] in ["UNKNOWN", "RATELIMIT"]:
             # resubmit
-            time.sleep(5 + np.random.randint(0, 5))
-            out = self._submit()
+            self._wait(attempt, retry_after)
+            attempt += 1
+            out, retry_after = self._submit()
 
-        logging.debug(f"ID: { out[ 'id' ] }")
+        idx = out["id"]
+        logging.debug(f"ID: { idx }")
 
+        attempt = 0
         while out["status"] in ["UNKNOWN", "RUNNING", "PENDING"]:
-            time.sleep(5 + np.random.randint(0, 5))
-            out = self._status(out["id"])
+            self._wait(attempt, retry_after)
+            status = out["status"]
+            out, retry_after = self._status(idx)
+            # Poll quickly again whenever the job moves on to a new state
+            attempt = attempt + 1 if out["status"] == status else 0
 
         if out["status"] == "COMPLETE":
-            self._download(out["id"], self.tarfile)
+            self._download(idx, self.tarfile)
 
         elif out["status"] == "ERROR":
             raise RuntimeError(
@@ -256,7 +349,137 @@ class MMSeqs2Runner:
                 )
             )
 
-    def process_templates(self, templates: List[str] = [], exclude_gpcr_subfamily = None ) -> list:
+    def _cached_get_json(self, url: str):
+
+        r"""Fetch JSON from a URL, reusing responses cached on disk by earlier runs
+
+        Parameters
+        ----------
+        url : URL to fetch
+
+        Returns
+        ----------
+        Decoded JSON response
+
+        """
+
+        cache_file = os.path.join(
+            self._cache_dir, hashlib.sha1(url.encode()).hexdigest() + ".json"
+        )
+        try:
+            with open(cache_file, "r") as infile:
+                return json.load(infile)
+        except FileNotFoundError:
+            pass
+
+        r = self.session.get(url, timeout=HTTP_TIMEOUT)
+        rj = r.json()
+        # Only cache successful responses; write to a temporary file first so
+        # concurrent lookups never read a partially written entry
+        if r.ok:
+            tmp_file = f"{ cache_file }.{ os.getpid() }.{ threading.get_ident() }"
+            with open(tmp_file, "w") as outfile:
+                json.dump(rj, outfile)
+            os.replace(tmp_file, cache_file)
+        return rj
+
+    def _classify_gpcrdb(self, pdbids: List[str], activation_state: str, exclude_gpcr_subfamily = None) -> dict:
+
+        r"""Check which structures match the requested GPCRdb annotation
+
+        Parameters
+        ----------
+        pdbids : Upper case pdb codes without chain
+        activation_state : Requested state or signalling protein
+        exclude_gpcr_subfamily : GPCRdb subfamily to exclude (e.g. 001_003_003)
+
+        Returns
+        ----------
+        Dictionary mapping each pdb code to whether it passes all criteria
+
+        """
+
+        def passes(pdbid):
+            # Fetch information from GPCRdb
+            url = "http://gpcrdb.org/services/structure/{}".format( pdbid )
+            rj = self._cached_get_json( url )
+            # Check subfamily exclusion
+            if type(rj) is dict and exclude_gpcr_subfamily is not None and rj["family"].startswith(exclude_gpcr_subfamily):
+                wrong_subfamily = True
+            else:
+                wrong_subfamily = False
+            # Check activation state
+            if type(rj) is dict and rj["state"] == activation_state:
+                correct_activation_state = True
+            elif type(rj) is dict and "signalling_protein" in rj and rj["signalling_protein"]["type"] == activation_state:
+                correct_activation_state = True
+            else:
+                correct_activation_state = False
+            return correct_activation_state and not wrong_subfamily
+
+        # GPCRdb has no batch endpoint, so query the structures concurrently
+        with futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            return dict(zip(pdbids, executor.map(passes, pdbids)))
+
+    def _classify_klifs(self, pdbids: List[str], dfg: str, ac_helix: str, salt_bridge: str) -> dict:
+
+        r"""Check which structures match the requested KLIFS conformation
+
+        Parameters
+        ----------
+        pdbids : Upper case pdb codes without chain
+        dfg : DFG conformation (in, out, out-like or all)
+        ac_helix : aC helix conformation (in, out or all)
+        salt_bridge : KIII.17-EaC.24 salt bridge (yes, no or all)
+
+        Returns
+        ----------
+        Dictionary mapping each pdb code to whether it passes all criteria
+
+        """
+
+        # KLIFS accepts comma-separated lists, so look up many structures per request
+        # Keep the first KLIFS structure listed for each pdb code
+        structure_IDs = {}
+        for i in range(0, len(pdbids), KLIFS_BATCH_SIZE):
+            url = "https://klifs.net/api_v2/structures_pdb_list?pdb-codes={}".format(
+                ",".join(pdbids[i : i + KLIFS_BATCH_SIZE])
+            )
+            # Errors (e.g. none of the pdb codes is in KLIFS) come back as [400, message]
+            for structure in self._cached_get_json( url ):
+                if isinstance(structure, dict):
+                    structure_IDs.setdefault(structure["pdb"].upper(), structure["structure_ID"])
+
+        #take structure_ID values and search for structure_conformation
+        conformations = {}
+        ids = list(structure_IDs.values())
+        for i in range(0, len(ids), KLIFS_BATCH_SIZE):
+            url = "https://klifs.net/api_v2/structure_conformation?structure_ID={}".format(
+                ",".join(str(structure_ID) for structure_ID in ids[i : i + KLIFS_BATCH_SIZE])
+            )
+            for conformation in self._cached_get_json( url ):
+                if isinstance(conformation, dict):
+                    conformations[conformation["structure_ID"]] = conformation
+
+        # Build the filter once; criteria set to "all" always pass
+        dfg_pred = (lambda c: True) if dfg == "all" else (lambda c: c["DFG"] == dfg)
+        helix_pred = (lambda c: True) if ac_helix == "all" else (lambda c: c["ac_helix"] == ac_helix)
+        if salt_bridge == "all":
+            sb_pred = lambda c: True
+        else:
+            # A KIII.17-EaC.24 distance of up to 4.5 A counts as a salt bridge
+            has_sb = salt_bridge == "yes"
+            sb_pred = lambda c: (0 < float(c["salt_bridge_17_24"]) <= 4.5) == has_sb
+        passes = lambda c: dfg_pred(c) and helix_pred(c) and sb_pred(c)
+
+        return {
+            pdbid: pdbid in structure_IDs
+            and structure_IDs[pdbid] in conformations
+            and passes(conformations[structure_IDs[pdbid]])
+            for pdbid in pdbids
+        }
+
+    def process_templates(self, templates: Optional[Sequence[str]] = None, exclude_gpcr_subfamily = None ) -> list:
 
         r"""Process templates and fetch from MMSeqs2 server
 
@@ -272,139 +495,105 @@ class MMSeqs2Runner:
 
         """
 
-        path = f"{ self.job }_env/templates_101"
-        if os.path.isdir(path):
-            os.system(f"rm -r { path }")
+        templates = tuple(templates) if templates else ()
+        first = templates[0] if templates else None
 
         # templates = {}
         logging.info("\t".join(("seq", "pdb", "cid", "evalue")))
 
-        pdbs = []
-        check_duplicates = []
-        # Upper case pdb codes, so the comparison to exclude templates becomes case insensitive
-        templates_upper = [t.upper() for t in templates if isinstance(t, str)]
-        with open(f"{ self.path }/pdb70.m8", "r") as infile:
-
-            for line in infile:
-                 
-                sl = line.rstrip().split()
-                pdb = sl[1]
-                pdbid = pdb.split("_")[0]
-                # GPCRdb only accepts pdb codes in uppercase (otherwise the returned request will be empty)
-                pdbid = pdbid.upper()
-                if templates:
-                    if templates[0] in ["Active", "Inactive", "Intermediate", "G protein", "Arrestin"] and pdbid not in check_duplicates and pdbid not in templates_upper:
-                        activation_state = templates[0]
-                        # Fetch information from GPCRdb
-                        url = "http://gpcrdb.org/services/structure/{}".format( pdbid )
-                        r = requests.get( url )
-                        rj = r.json()
-                        # Check subfamily exclusion
-                        if type(rj) is dict and exclude_gpcr_subfamily is not None and rj["family"].startswith(exclude_gpcr_subfamily):
-                            wrong_subfamily = True
-                        else:
-                            wrong_subfamily = False
-                        # Check activation state
-                        if type(rj) is dict and rj["state"] == activation_state:
-                            correct_activation_state = True
-                        elif type(rj) is dict and "signalling_protein" in rj and rj["signalling_protein"]["type"] == activation_state:
-                            correct_activation_state = True
-                        else:
-                            correct_activation_state = False
-                        # Proceed with pdbs passing all criteria
-                        if correct_activation_state and not wrong_subfamily:
-                            pdbs.append(pdb)
-                            check_duplicates.append(pdbid)    
-                                            
-                    if len(templates[0]) == 3 and pdbid not in check_duplicates and pdbid not in templates:
-                        if templates[0][0] in ["in", "out", "out-like"]:
-                            dfg = templates[0][0]
-                        elif templates[0][0] == "all":
-                            dfg = "all"
-                        else:
-                            raise RuntimeError("DFG value invalid")
-                        if templates[0][1] in ["in", "out",]:    
-                            ac_helix = templates[0][1]
-                        elif templates[0][1] == "all":
-                            ac_helix = "all"
-                        else:
-                            raise RuntimeError("ac_helix value invalid")       
-                        if templates[0][2] in  ["yes", "no", "all"]:
-                            salt_bridge = templates[0][2]
-                        else:
-                            raise RuntimeError("salt_bridge value invalid")
-                        url = "https://klifs.net/api_v2/structures_pdb_list?pdb-codes={}".format( pdbid )
-                        r = requests.get( url )
-                        rj = r.json()
-                        #print(rj)
-                        if rj[0] != 400:           
-                            #take kinase_ID value and search for structure_conformation
-                            structure_ID = rj[0]["structure_ID"]
-                            url = "https://klifs.net/api_v2/structure_conformation?structure_ID={}".format( structure_ID )
-                            r = requests.get( url )
-                            rj = r.json()
-                            #print(rj)
-                            if float(rj[0]["salt_bridge_17_24"]) > 0 and float(rj[0]["salt_bridge_17_24"]) <= 4.5:
-                                ref_sb = "yes"
-                            else:
-                                ref_sb = "no"
-                            if dfg != "all" and ac_helix != "all" and salt_bridge != "all":
-                                if rj[0]["DFG"] == dfg and rj[0]["ac_helix"] == ac_helix and  salt_bridge == ref_sb:
-                                    pdbs.append(pdb)
-                                    check_duplicates.append(pdbid)
-                            elif dfg != "all" and ac_helix != "all" and salt_bridge == "all":
-                                if rj[0]["DFG"] == dfg and rj[0]["ac_helix"] == ac_helix:
-                                    pdbs.append(pdb)
-                                    check_duplicates.append(pdbid)
-                            elif dfg != "all" and ac_helix == "all" and salt_bridge != "all":
-                                if rj[0]["DFG"] == dfg and salt_bridge == ref_sb:
-                                    pdbs.append(pdb)
-                                    check_duplicates.append(pdbid)
-                            elif dfg != "all" and ac_helix == "all" and salt_bridge == "all":
-                                if rj[0]["DFG"] == dfg:
-                                    pdbs.append(pdb)
-                                    check_duplicates.append(pdbid)
-                            elif dfg == "all" and ac_helix != "all" and salt_bridge != "all":
-                                if rj[0]["ac_helix"] == ac_helix and salt_bridge == ref_sb:
-                                    pdbs.append(pdb)
-                                    check_duplicates.append(pdbid)
-                            elif dfg == "all" and ac_helix != "all" and salt_bridge == "all":
-                                if rj[0]["ac_helix"] == ac_helix:
-                                    pdbs.append(pdb)
-                                    check_duplicates.append(pdbid)
-                            elif dfg == "all" and ac_helix == "all" and salt_bridge != "all":
-                                if salt_bridge == ref_sb:
-                                    pdbs.append(pdb)
-                                    check_duplicates.append(pdbid)
-                            elif dfg == "all" and ac_helix == "all" and salt_bridge == "all":
-                                pdbs.append(pdb)
-                                check_duplicates.append(pdbid)                           
-                    
-                    elif pdb in templates:
-                        pdbs.append(sl[1])
-                        logging.info(f"{ sl[0] }\t{ sl[1] }\t{ sl[2] }\t{ sl[10] }")
+        # Decide once how hits are selected: by GPCRdb state, by KLIFS conformation, or by explicit pdb list
+        classify = None
+        if first in GPCRDB_STATES:
+            classify = functools.partial(
+                self._classify_gpcrdb,
+                activation_state=first,
+                exclude_gpcr_subfamily=exclude_gpcr_subfamily,
+            )
+            # Upper case pdb codes, so the comparison to exclude templates becomes case insensitive
+            excluded = {t.upper() for t in templates if isinstance(t, str)}
+        # Kinase conformations are a [DFG, aC_helix, salt_bridge] list; a pdb code may also be 3 characters long
+        elif isinstance(first, (list, tuple)) and len(first) == 3:
+            dfg, ac_helix, salt_bridge = first
+            if dfg not in ["in", "out", "out-like", "all"]:
+                raise RuntimeError("DFG value invalid")
+            if ac_helix not in ["in", "out", "all"]:
+                raise RuntimeError("ac_helix value invalid")
+            if salt_bridge not in ["yes", "no", "all"]:
+                raise RuntimeError("salt_bridge value invalid")
+            classify = functools.partial(
+                self._classify_klifs,
+                dfg=dfg,
+                ac_helix=ac_helix,
+                salt_bridge=salt_bridge,
+            )
+            excluded = {t for t in templates if isinstance(t, str)}
+
+        # First pass: parse all hits at once (query, target, identity and e-value columns)
+        with warnings.catch_warnings():
+            # An empty m8 file just means there are no hits
+            warnings.simplefilter("ignore", UserWarning)
+            hits = np.loadtxt(
+                f"{ self.path }/pdb70.m8", dtype=str, usecols=(0, 1, 2, 10), ndmin=2
+            ).reshape(-1, 4)
+        # GPCRdb only accepts pdb codes in uppercase (otherwise the returned request will be empty)
+        # (np.char.partition cannot handle an empty array)
+        pdbids = np.char.upper(np.char.partition(hits[:, 1], "_")[:, 0] if len(hits) else hits[:, 1])
+        if classify is not None:
+            keep = ~np.isin(pdbids, np.array(list(excluded), dtype=str))
+        else:
+            keep = np.isin(hits[:, 1], np.array(list({t for t in templates if isinstance(t, str)}), dtype=str))
+            for row in hits[keep]:
+                logging.info("\t".join(row))
+        candidates = list(zip(hits[keep, 1].tolist(), pdbids[keep].tolist()))
+
+        if classify is None:
+            pdbs = [pdb for pdb, _ in candidates]
+        else:
+            # Second pass: query GPCRdb/KLIFS once per pdb code
+            passed = classify(list(dict.fromkeys(pdbid for _, pdbid in candidates)))
+
+            # Keep hits in m8 order, skipping pdb codes that were already accepted
+            pdbs = []
+            check_duplicates = set()
+            for pdb, pdbid in candidates:
+                if pdbid not in check_duplicates and passed[pdbid]:
+                    pdbs.append(pdb)
+                    check_duplicates.add(pdbid)
         
         #write comma-seprated pdbs to file
         with open(f"{ self.path }/template_pdbs.txt", "w") as outfile:
-            for pdb in pdbs:
-                outfile.write(f"{ pdb },")
+            outfile.write(",".join(pdbs))
         
         return self.download_templates(pdbs)
         
+    def _prepare_templates_dir(self) -> str:
+
+        r"""Create an empty directory for the templates, removing any previous one
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        ----------
+        Path to the templates directory
+
+        """
+
+        path = f"{ self.job }_env/templates_101"
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+        return path
+
     def download_templates(self, pdbs) -> str:
         """Shuffle templates."""
         
-        path = f"{ self.job }_env/templates_101"
-        if os.path.isdir(path):
-            os.system(f"rm -r { path }")
+        path = self._prepare_templates_dir()
             
         if len(pdbs) == 0:
             logging.warning("No templates found.")
             return ""
         else:
-            if not os.path.isdir(path):
-                os.mkdir(path)
-            
             if len(pdbs) > 1 and self.shuffling_templates:
                 random.shuffle(pdbs)
             
@@ -412,16 +601,50 @@ class MMSeqs2Runner:
         
             logging.info("TEMPLATE PDBS USED: " + pdbs)
 
-            os.system(f"wget -q -O - { self.t_url }/{ pdbs } |tar xzf - -C { path }/")
+            # Stream the archive straight into tarfile instead of going through disk
+            with self.session.get(
+                f"{ self.t_url }/{ pdbs }", stream=True, timeout=HTTP_TIMEOUT
+            ) as r:
+                r.raw.decode_content = True
+                with tarfile.open(fileobj=r.raw, mode="r|gz") as tar_gz:
+                    tar_gz.extractall(path)
 
-            os.system(f"cp { path }/pdb70_a3m.ffindex { path }/pdb70_cs219.ffindex")
+            shutil.copyfile(f"{ path }/pdb70_a3m.ffindex", f"{ path }/pdb70_cs219.ffindex")
 
-            os.system(f"touch { path }/pdb70_cs219.ffdata")
+            open(f"{ path }/pdb70_cs219.ffdata", "a").close()
 
             return path
 
+    def _extract_tar(self, tar: tarfile.TarFile, path: str) -> NoReturn:
+
+        r"""Extract a tar archive, copying members with a large buffer
+        (tarfile.extractall copies in 16 KiB blocks)
+
+        Parameters
+        ----------
+        tar : Opened tar archive
+        path : Directory to extract to
+
+        Returns
+        ----------
+        None
+
+        """
+
+        for member in tar:
+            if os.path.isabs(member.name) or ".." in member.name.split("/"):
+                logging.warning(f"Skipping unsafe archive member { member.name }")
+                continue
+            target = os.path.join(path, member.name)
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+            elif member.isfile():
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with tar.extractfile(member) as src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst, IO_BUFFER_SIZE)
+
     def _process_alignment(
-        self, a3m_files: list, templates: List[str] = [], exclude_gpcr_subfamily = None,
+        self, a3m_files: list, templates: Optional[Sequence[str]] = None, exclude_gpcr_subfamily = None,
     ) -> Tuple[str, str]:
 
         r"""Process sequence alignment
@@ -438,16 +661,24 @@ class MMSeqs2Runner:
 
         """
 
-        a3m_lines = ""
+        # Template selection is network bound, so let it run while the alignment is read
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            template_future = executor.submit(
+                self.process_templates, templates, exclude_gpcr_subfamily = exclude_gpcr_subfamily
+            )
+
+            # Read each file in one go and join once, rather than concatenating line by line
+            chunks = []
+
+            for a3m_file in a3m_files:
+                with open(os.path.join(self.path, a3m_file), "rb", buffering=IO_BUFFER_SIZE) as infile:
+                    chunks.append(infile.read().replace(b"\x00", b""))
 
-        for a3m_file in a3m_files:
-            for line in open(os.path.join(self.path, a3m_file), "r"):
-                if len(line) > 0:
-                    a3m_lines += line.replace("\x00", "")
+            a3m_lines = b"".join(chunks).decode()
 
-        return a3m_lines, self.process_templates(templates, exclude_gpcr_subfamily = exclude_gpcr_subfamily)
+            return a3m_lines, template_future.result()
 
-    def run_job(self, templates: List[str] = [], exclude_gpcr_subfamily = None) -> Tuple[str, str]:
+    def run_job(self, templates: Optional[Sequence[str]] = None, exclude_gpcr_subfamily = None) -> Tuple[str, str]:
 
         r"""
         Run sequence alignments using MMseqs2
@@ -468,8 +699,18 @@ class MMSeqs2Runner:
 
         # extract a3m files
         if not os.path.isfile(os.path.join(self.path, a3m_files[0])):
-            with tarfile.open(self.tarfile) as tar_gz:
-                tar_gz.extractall(self.path)
+            if shutil.which("pigz") is not None:
+                # Let pigz decompress in a separate process and stream the plain tar
+                with subprocess.Popen(
+                    ["pigz", "-dc", self.tarfile], stdout=subprocess.PIPE, bufsize=IO_BUFFER_SIZE
+                ) as proc:
+                    with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                        self._extract_tar(tar, self.path)
+                if proc.returncode != 0:
+                    raise RuntimeError(f"pigz failed to decompress { self.tarfile }")
+            else:
+                with tarfile.open(self.tarfile, "r:gz") as tar_gz:
+                    self._extract_tar(tar_gz, self.path)
 
         return self._process_alignment(a3m_files, templates, exclude_gpcr_subfamily = exclude_gpcr_subfamily)
     
@@ -487,13 +728,9 @@ class MMSeqs2Runner:
         Tuple with [0] string with alignment, and [1] path to template
 
         """
-        #read input file and extract the fir row in a list
+        #read input file and extract the fir row in a list (older files end with a trailing comma)
         with open(f"{ self.path }/template_pdbs.txt", "r") as infile:
-            pdbs = infile.read().split(",")
-        
-        #remove last element of a list if it is empty
-        if pdbs[-1] == "":
-            pdbs.pop()
+            pdbs = [pdb for pdb in infile.read().split(",") if pdb]
         print("READ_LIST: ", pdbs)
         
         if len(pdbs) > 1: